@@ -1,12 +1,17 @@
 import streamlit as st
 import streamlit.components.v1 as components
+import os
 import random
+import sys
+import threading
 import time
 import json
-import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from google import genai
 from google.genai import types
-from supabase import create_client
+from supabase import create_client, ClientOptions
+from supabase import PostgrestAPIError
 
 # ==========================================
 # 0. アプリ基本設定 (これが一番上にないといけない)
@@ -30,6 +35,51 @@ RANK_TAGS = {
     "マスターボール級 (難関: 700点+)": "master"
 }
 
+# サイドバーの選択肢と、ランク名 → 何番目のランクか (出てくるポケモンの世代を決める)
+RANK_OPTIONS = (*RANK_MAP, "🔥 復習モード (Revenge)")
+RANK_INDEX = {name: i for i, name in enumerate(RANK_MAP)}
+
+# DB接続もできない場合の最終手段 (変更しないので (英語, 日本語) のタプルで持つ)
+FALLBACK_WORDS = (
+    ("Error", "エラー"),
+    ("Retry", "再読込"),
+    ("Check", "確認"),
+    ("Connection", "接続"),
+    ("Database", "DB"),
+    ("System", "システム"),
+    ("Update", "更新"),
+    ("Wait", "待機"),
+)
+
+GEMINI_MODEL = "gemini-1.5-flash"
+QUIZ_CACHE_SLOTS = 8  # ランクごとにキャッシュしておく出題リクエストの数
+QUIZ_DRAFTS = 4  # 出題で一度に作る案の数 (残りは次回以降のゲームで使う)
+QUIZ_WORDS = 8  # 1ゲームの単語数 (盤面は 4x4 の16枚)
+
+# 出題のレスポンスの形 (Gemini の response_schema)
+QUIZ_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "words": {
+            "type": "ARRAY",
+            "minItems": QUIZ_WORDS,
+            "maxItems": QUIZ_WORDS,
+            "items": {
+                "type": "OBJECT",
+                "properties": {"en": {"type": "STRING"}, "jp": {"type": "STRING"}},
+                "required": ["en", "jp"],
+            },
+        },
+        "story": {"type": "STRING"},
+    },
+    "required": ["words", "story"],
+}
+SPRITE_URL = "https://raw.githubusercontent.com/PokeAPI/sprites/master/sprites/pokemon/{}.png"  # PokeAPI の front_default と同じ画像
+STORY_DRAFTS = 3  # 物語生成で一度に作る下書きの数
+STORY_STORE_MAX = 500  # 生成済みの物語を覚えておく単語の組の数
+STORY_STORE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".story_cache.json")  # 物語の保存先
+STORY_TIMEOUT_MS = 10_000  # 物語生成の待ち時間の上限 (ミリ秒)。超えたら諦めて結果画面を出す
+
 # Secretsの読み込み確認
 try:
     SUPABASE_URL = st.secrets["supabase"]["url"]
@@ -38,15 +88,33 @@ except:
     st.error("⚠️ Secretsの設定が見つかりません。'.streamlit/secrets.toml' を確認してください。")
     st.stop()
 
+# 開発用の表示は secrets.toml に debug = true を書いたときだけ出す
+DEBUG = bool(st.secrets.get("debug", False))
+
 @st.cache_resource
 def init_supabase():
+    # cache_resource で1つのクライアントを全セッションで共有する。
+    # PostgREST 側はクライアントごとに httpx の接続を持ち続けるので、DB呼び出しは keep-alive で使い回される
     try:
-        return create_client(SUPABASE_URL, SUPABASE_KEY)
+        return create_client(
+            SUPABASE_URL, SUPABASE_KEY,
+            options=ClientOptions(postgrest_client_timeout=10),
+        )
     except Exception as e:
         return None
 
 supabase = init_supabase()
 
+@st.cache_resource
+def get_genai_client(api_key):
+    """APIキーごとにGeminiクライアントを使い回す (再実行のたびに作り直さない)"""
+    return genai.Client(api_key=api_key)
+
+@st.cache_resource
+def get_executor():
+    """裏で通信するためのスレッドプール (全セッションで共有し、再実行をまたいで使い回す)"""
+    return ThreadPoolExecutor(max_workers=4)
+
 if not supabase:
     st.error("⚠️ データベースに接続できませんでした。")
     st.stop()
@@ -56,12 +124,14 @@ if not supabase:
 # ==========================================
 
 def play_pronunciation(text):
-    """ブラウザ標準機能で音声再生"""
+    """ブラウザ標準機能で音声再生 (音声ファイルは取得しない)"""
+    # 引用符や </script> が入っていても壊れないよう、JSの文字列リテラルとして埋め込む
+    text_js = json.dumps(text).replace("</", "<\\/")
     js_code = f"""
     <script>
         function speak() {{
             const msg = new SpeechSynthesisUtterance();
-            msg.text = "{text}";
+            msg.text = {text_js};
             msg.lang = 'en-US';
             window.speechSynthesis.speak(msg);
         }}
@@ -71,26 +141,16 @@ def play_pronunciation(text):
     components.html(js_code, height=0)
 
 def get_random_pokemon_data(rank_index):
-    """PokeAPIからIDと画像を取得"""
-    try:
-        if rank_index == 0:
-            poke_id = random.randint(1, 151)
-        elif rank_index == 1:
-            poke_id = random.randint(152, 251)
-        elif rank_index == 2:
-            poke_id = random.randint(252, 386)
-        else:
-            poke_id = random.randint(387, 1000) 
-
-        url = f"https://pokeapi.co/api/v2/pokemon/{poke_id}"
-        res = requests.get(url, timeout=3) # タイムアウト設定でフリーズ防止
-        if res.status_code == 200:
-            data = res.json()
-            img_url = data["sprites"]["front_default"]
-            return poke_id, img_url
-    except:
-        pass
-    return None, None
+    """ランクに合った世代のポケモンのIDと画像URLを返す (画像URLはIDから決まるので通信しない)"""
+    if rank_index == 0:
+        poke_id = random.randint(1, 151)
+    elif rank_index == 1:
+        poke_id = random.randint(152, 251)
+    elif rank_index == 2:
+        poke_id = random.randint(252, 386)
+    else:
+        poke_id = random.randint(387, 1000) 
+    return poke_id, SPRITE_URL.format(poke_id)
 
 def get_fallback_words_from_db(rank_name):
     """AIがない場合、DBから単語を取得する"""
@@ -101,155 +161,489 @@ def get_fallback_words_from_db(rank_name):
         data = res.data
         
         # データ不足時は全データから補充
-        if len(data) < 8:
+        if len(data) < QUIZ_WORDS:
             res_all = supabase.table("toeic_words").select("word_en, word_jp").execute()
             data = res_all.data
             
-        if data and len(data) >= 8:
-            selected = random.sample(data, 8)
+        if data and len(data) >= QUIZ_WORDS:
+            selected = random.sample(data, QUIZ_WORDS)
             return [{"en": item["word_en"], "jp": item["word_jp"]} for item in selected]
             
     except Exception:
         pass
     
     # 最終手段（DB接続もダメな場合）
-    return [
-        {"en": "Error", "jp": "エラー"},
-        {"en": "Retry", "jp": "再読込"},
-        {"en": "Check", "jp": "確認"},
-        {"en": "Connection", "jp": "接続"},
-        {"en": "Database", "jp": "DB"},
-        {"en": "System", "jp": "システム"},
-        {"en": "Update", "jp": "更新"},
-        {"en": "Wait", "jp": "待機"}
-    ]
+    return [{"en": en, "jp": jp} for en, jp in FALLBACK_WORDS]
 
-def generate_quiz_words(api_key, rank_prompt, rank_name_for_db):
-    """AIに単語リストを作らせる (失敗したらDBから取る)"""
-    if not api_key:
-        return get_fallback_words_from_db(rank_name_for_db)
+@st.cache_data(ttl=3600, max_entries=32, show_spinner=False)
+def _cached_quiz_words(rank_prompt, slot, _api_key):
+    """ランクごとに QUIZ_CACHE_SLOTS 通りの出題案を使い回す (失敗時は例外のままキャッシュしない)
+
+    1回のリクエストで QUIZ_DRAFTS 個の (単語リスト, 物語) を作って返す。
 
-    client = genai.Client(api_key=api_key)
+    slot は中身では使わず、キャッシュを何通りかに分けて出題のバリエーションを残すためだけのキー。
+    """
+    client = get_genai_client(_api_key)
     
     prompt = f"""
-    Generate 8 unique English vocabulary words specifically for {rank_prompt}.
+    Generate {QUIZ_WORDS} unique English vocabulary words specifically for {rank_prompt}.
     The words should be commonly found in TOEIC tests but NOT exceeding the 750 score level.
-    Output MUST be a valid JSON list of objects with 'en' (English word) and 'jp' (Japanese meaning).
-    Example: [{{"en": "Profit", "jp": "利益"}}, {{"en": "Hire", "jp": "雇う"}}]
-    Just the raw JSON string.
+    Also write a short and **simple** Pokémon-style adventure story in English using all {QUIZ_WORDS} words.
+    The story should be easy to read (suitable for TOEIC 600 learners), highlight the used words in **bold**, and be under 100 words.
+    Return 'words' (each with 'en' = English word, 'jp' = Japanese meaning) and 'story'.
     """
     
-    try:
-        response = client.models.generate_content(
-            model="gemini-1.5-flash",
-            contents=prompt,
-            config=types.GenerateContentConfig(response_mime_type="application/json")
+    # スキーマで出力の形を固定し、余計な前置きや空白でトークンを使わせない
+    response = client.models.generate_content(
+        model=GEMINI_MODEL,
+        contents=prompt,
+        config=types.GenerateContentConfig(
+            response_mime_type="application/json",
+            response_schema=QUIZ_SCHEMA,
+            candidate_count=QUIZ_DRAFTS,
+            max_output_tokens=800,  # 単語8組 + 100語までの物語が JSON ごと収まる量
+            temperature=0.9,
         )
-        return json.loads(response.text)
+    )
+    # ブロックされた案や途中で切れた案だけ捨て、使える案が1つもないときだけ失敗にする
+    drafts = []
+    for cand in response.candidates or []:
+        try:
+            data = json.loads(cand.content.parts[0].text)
+            words = tuple((w["en"], w["jp"]) for w in data["words"])
+        except Exception:
+            continue
+        # 単語が足りない案は盤面が欠けるので使わない
+        if len(words) == QUIZ_WORDS:
+            drafts.append((words, data.get("story")))
+    if not drafts:
+        raise ValueError("no usable quiz drafts")
+    return tuple(drafts)
+
+def generate_quiz_words(api_key, rank_prompt, rank_name_for_db):
+    """AIに単語リストと、全単語を使った物語を作らせる (失敗したらDBから単語だけ取る)
+
+    物語も同じリクエストで作っておけば、全部揃えたときに物語用の通信が要らない。
+    戻り値は出題案 (単語リスト, 物語 or None) のリスト。
+    """
+    if not api_key:
+        return [(get_fallback_words_from_db(rank_name_for_db), None)]
+
+    try:
+        drafts = _cached_quiz_words(rank_prompt, random.randrange(QUIZ_CACHE_SLOTS), api_key)
+        return [([{"en": en, "jp": jp} for en, jp in words], story) for words, story in drafts]
     except:
-        return get_fallback_words_from_db(rank_name_for_db)
+        return [(get_fallback_words_from_db(rank_name_for_db), None)]
+
+@st.cache_resource
+def _story_store():
+    """生成済みの物語 (下書き) の置き場 (全セッションで共有)。(書き込み用のロック, dict) を返す
 
-def get_english_story(api_key, words):
-    """英語の物語生成"""
-    if not api_key: return "Story generation skipped (Needs AI Key)."
-    client = genai.Client(api_key=api_key)
+    起動時に STORY_STORE_PATH から読み込むので、アプリを再起動しても同じ単語の組なら使い回せる。
+    """
+    try:
+        with open(STORY_STORE_PATH, encoding="utf-8") as f:
+            store = json.load(f)
+    except: store = {}
+    return threading.Lock(), store
+
+def _story_key(words_key):
+    """単語の組 (ソート済み) とモデル名から、JSON に保存できる文字列のキーを作る"""
+    return json.dumps([GEMINI_MODEL, *words_key], ensure_ascii=False)
+
+def _save_story(key, drafts):
+    """物語をメモリとディスクの両方に保存する (いっぱいなら一番古いものから捨てる)"""
+    lock, store = _story_store()
+    with lock:
+        if len(store) >= STORY_STORE_MAX:
+            store.pop(next(iter(store)), None)
+        store[key] = list(drafts)
+        try:
+            # 書きかけのファイルを読まないよう、一時ファイルに書いてから置き換える
+            tmp = STORY_STORE_PATH + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(store, f, ensure_ascii=False)
+            os.replace(tmp, STORY_STORE_PATH)
+        except: pass  # 書き込めない環境でも、メモリ上の分は使える
+
+def _stream_story(api_key, words_key, drafts):
+    """1つ目の下書きを少しずつ返しながら、全下書きを drafts に集める"""
+    client = get_genai_client(api_key)
     prompt = f"""
-    Write a short and **simple** Pokémon-style adventure story in English using these words: {', '.join(words)}.
+    Write a short and **simple** Pokémon-style adventure story in English using these words: {', '.join(words_key)}.
     The English level should be easy to read (suitable for TOEIC 600 learners).
     Highlight the used words in **bold**.
     Keep it under 100 words.
     """
+    # 1回のリクエストで複数の下書きを作っておき、「別の物語」は再リクエストせずに切り替える
+    stream = client.models.generate_content_stream(
+        model=GEMINI_MODEL,
+        contents=prompt,
+        config=types.GenerateContentConfig(
+            candidate_count=STORY_DRAFTS,
+            max_output_tokens=200,
+            # 接続・1回の読み込みごとの上限。全体の上限は下のループで見る
+            http_options=types.HttpOptions(timeout=STORY_TIMEOUT_MS),
+        ),
+    )
+    deadline = time.monotonic() + STORY_TIMEOUT_MS / 1000
+    texts = {}
+    for chunk in stream:
+        # 少しずつ届き続けると通信の timeout では止まらないので、全体の時間もここで区切る
+        if time.monotonic() > deadline:
+            raise TimeoutError("story generation took too long")
+        for cand in chunk.candidates or []:
+            if not cand.content or not cand.content.parts:
+                continue
+            text = "".join(p.text or "" for p in cand.content.parts)
+            idx = cand.index or 0
+            texts[idx] = texts.get(idx, "") + text
+            if idx == 0 and text:
+                yield text
+    drafts.extend(texts[i] for i in sorted(texts))
+
+def write_english_story(api_key, words):
+    """英語の物語を生成しながら画面に表示し、下書きのリストを返す"""
+    if not api_key: return ["Story generation skipped (Needs AI Key)."]
+    # 並び順が違うだけでキャッシュが外れないようにソートしてキーにする
+    words_key = tuple(sorted(words))
+    _, store = _story_store()
+    key = _story_key(words_key)
+    if key in store:
+        return list(store[key])
+
+    drafts = []
     try:
-        response = client.models.generate_content(model="gemini-1.5-flash", contents=prompt)
-        return response.text
-    except:
-        return "Failed to generate story."
+        st.write_stream(_stream_story(api_key, words_key, drafts))
+    except Exception as e:
+        # タイムアウトなどの理由は画面に出す (失敗した結果はキャッシュしない)
+        return [f"Failed to generate story. ({type(e).__name__})"]
+    # 途中で止まって空になった下書きは保存しない
+    drafts = [d for d in drafts if d.strip()]
+    if not drafts:
+        return ["Failed to generate story."]
+    _save_story(key, drafts)
+    return drafts
 
 # --- DB操作 ---
 
 def save_pokedex(poke_id):
     if not poke_id: return
     try:
-        chk = supabase.table("user_pokedex").select("id").eq("pokemon_id", poke_id).execute()
-        if not chk.data:
-            supabase.table("user_pokedex").insert({"pokemon_id": poke_id}).execute()
+        # pokemon_id の UNIQUE 制約で重複を弾く (登録済みなら data は空で返る)
+        res = supabase.table("user_pokedex").upsert(
+            {"pokemon_id": poke_id}, on_conflict="pokemon_id", ignore_duplicates=True
+        ).execute()
+        if res.data:
+            get_my_pokedex.clear()
             return True 
     except: pass
     return False
 
+@st.cache_data(ttl=30, show_spinner=False)
 def get_my_pokedex():
     try:
         res = supabase.table("user_pokedex").select("pokemon_id").execute()
         return [r["pokemon_id"] for r in res.data]
     except: return []
 
-def save_mistake(en, jp):
+def save_mistakes(words):
+    """1ゲーム分の苦手単語をまとめて1回の upsert で登録する"""
+    if not words: return
     try:
-        chk = supabase.table("mistaken_words").select("id").eq("word_en", en).execute()
-        if not chk.data:
-            supabase.table("mistaken_words").insert({"word_en": en, "word_jp": jp}).execute()
+        # word_en の UNIQUE 制約で重複を弾く (登録済みの行は data に含まれない)
+        rows = [{"word_en": w["en"], "word_jp": w["jp"]} for w in words]
+        res = supabase.table("mistaken_words").upsert(
+            rows, on_conflict="word_en", ignore_duplicates=True
+        ).execute()
+        if res.data:
+            get_mistakes_count.clear()
+            get_mistake_rows.clear()
     except: pass
 
-def increment_correct_count(en):
+def is_missing_rpc(e):
+    """README の SQL 関数がまだ作られていない DB で出るエラーか (PGRST202 / 404)"""
+    return e.code in ("PGRST202", "404")
+
+def increment_correct_counts(words):
+    """復習モードで揃えた単語の正解数をまとめて1つ足し、{英単語: 新しい正解数} を返す"""
+    if not words: return {}
     try:
-        res = supabase.table("mistaken_words").select("correct_count").eq("word_en", en).execute()
-        if res.data:
-            new_val = res.data[0]["correct_count"] + 1
-            supabase.table("mistaken_words").update({"correct_count": new_val}).eq("word_en", en).execute()
-            return new_val
+        # 1回の UPDATE ... RETURNING で足す (README の increment_correct)。読んでから書く間の競合もない
+        res = supabase.rpc("increment_correct", {"words": list(words)}).execute()
+        get_mistake_rows.clear()
+        return {r["word_en"]: r["correct_count"] for r in res.data}
+    except PostgrestAPIError as e:
+        # 関数がまだ作られていない DB のときだけ、下の方法でやり直す
+        if not is_missing_rpc(e):
+            return {}
+    except:
+        # タイムアウトや切断では UPDATE が済んでいるかもしれないので、やり直さない (二重に足さない)
+        return {}
+    # 関数がまだ作られていない DB では、まとめて読んでから1件ずつ書く
+    # (読んだ値のままの行だけ更新するので、同時に足された分や再実行で二重に足さない)
+    counts = {}
+    try:
+        res = supabase.table("mistaken_words").select("word_en, correct_count").in_("word_en", list(words)).execute()
+        for r in res.data:
+            new_val = r["correct_count"] + 1
+            upd = (
+                supabase.table("mistaken_words").update({"correct_count": new_val})
+                .eq("word_en", r["word_en"]).eq("correct_count", r["correct_count"]).execute()
+            )
+            if upd.data:
+                counts[r["word_en"]] = new_val
+        get_mistake_rows.clear()
     except: pass
-    return 0
+    return counts
 
-def delete_mistake(en):
+def delete_mistakes(words):
+    """卒業した単語をまとめて1回の delete で消す"""
+    if not words: return
     try:
-        supabase.table("mistaken_words").delete().eq("word_en", en).execute()
+        supabase.table("mistaken_words").delete().in_("word_en", list(words)).execute()
+        get_mistakes_count.clear()
+        get_mistake_rows.clear()
     except: pass
 
+@st.cache_data(ttl=30, show_spinner=False)
 def get_mistakes_count():
     try:
-        res = supabase.table("mistaken_words").select("id", count="exact").execute()
+        res = supabase.table("mistaken_words").select("id", count="exact", head=True).execute()
         return res.count
     except: return 0
 
-def fetch_revenge_words(limit=8):
+@st.cache_data(ttl=300, show_spinner=False)
+def get_mistake_rows():
+    """苦手単語の一覧 (英語, 日本語, 正解数)。書き込み時に clear する"""
     try:
-        res = supabase.table("mistaken_words").select("*").execute()
-        data = res.data
-        if not data: return []
-        random.shuffle(data)
-        return [{"en": i["word_en"], "jp": i["word_jp"], "count": i["correct_count"]} for i in data[:limit]]
+        res = supabase.table("mistaken_words").select("word_en, word_jp, correct_count").execute()
+        return [(i["word_en"], i["word_jp"], i["correct_count"]) for i in res.data]
     except: return []
 
+def fetch_revenge_words(limit=QUIZ_WORDS):
+    try:
+        # DB側でランダムに limit 件だけ選んで返す (README の get_random_mistakes)
+        res = supabase.rpc("get_random_mistakes", {"n": limit}).execute()
+        return [{"en": i["word_en"], "jp": i["word_jp"], "count": i["correct_count"]} for i in res.data]
+    except PostgrestAPIError as e:
+        if not is_missing_rpc(e):
+            return []
+    except:
+        # タイムアウトなどでは全件取得に切り替えない (通信量を減らすための関数なので)
+        return []
+    # 関数がまだ作られていない DB では、キャッシュした一覧から選ぶ
+    rows = get_mistake_rows()
+    if not rows: return []
+    picked = random.sample(rows, min(limit, len(rows)))
+    return [{"en": en, "jp": jp, "count": count} for en, jp, count in picked]
+
 # ==========================================
 # 3. ゲームロジック
 # ==========================================
-def init_game(word_list, time_limit, mode="NORMAL", poke_id=None, poke_img=None):
-    cards = []
-    for item in word_list:
-        cnt = item.get("count", 0)
-        cards.append({"id": item["en"], "text": item["en"], "pair": item["jp"], "is_jp": False, "count": cnt})
-        cards.append({"id": item["en"], "text": item["jp"], "pair": item["en"], "is_jp": True, "count": cnt})
-    
-    random.shuffle(cards)
-    
-    st.session_state.cards = cards
-    st.session_state.flipped = []
-    st.session_state.matched = set()
-    st.session_state.collected_now = [] 
-    st.session_state.mistakes_now = []
-    st.session_state.mastered_pending = []
-    st.session_state.current_mode = mode
-    
-    st.session_state.current_poke_id = poke_id
-    st.session_state.current_poke_img = poke_img
-    
-    st.session_state.start_time = time.time()
-    st.session_state.time_limit = time_limit
-    st.session_state.game_state = "PLAYING"
-    st.session_state.last_matched_word = None
+def quiz_pool(api_key, rank_name):
+    """まだ使っていない出題案の置き場 (ランクとAPIキーごと)"""
+    pools = st.session_state.setdefault("quiz_pool", {})
+    return pools.setdefault((api_key, rank_name), deque())
+
+def prefetch_quiz(api_key, rank_name):
+    """プレイ中に次のゲームの単語を裏で生成しておく"""
+    key = (api_key, rank_name)
+    if st.session_state.get("next_quiz_key") == key or quiz_pool(api_key, rank_name):
+        return
+    st.session_state.next_quiz_key = key
+    st.session_state.next_quiz_future = get_executor().submit(
+        generate_quiz_words, api_key, RANK_MAP[rank_name], rank_name
+    )
+
+def take_quiz_words(api_key, rank_name):
+    """(単語リスト, 物語) を1つ返す。残っている出題案 → 先読み → その場で生成 の順に使う"""
+    pool = quiz_pool(api_key, rank_name)
+    if pool:
+        return pool.popleft()
+
+    future = st.session_state.pop("next_quiz_future", None)
+    key = st.session_state.pop("next_quiz_key", None)
+    drafts = None
+    if future is not None and key == (api_key, rank_name) and (future.done() or future.running()):
+        # 生成途中でも、新しくリクエストし直すより待った方が早い
+        drafts = future.result()
+    elif future is not None:
+        # 共有のスレッドプールで順番待ちのままなら、他の人の処理を待たずにその場で作る
+        future.cancel()
+    if drafts is None:
+        drafts = generate_quiz_words(api_key, RANK_MAP[rank_name], rank_name)
+    pool.extend(drafts[1:])
+    return drafts[0]
+
+def build_card_template(word_list):
+    """単語リストから (英語のタプル, 日本語のタプル, カード番号のリスト) を作る (シャッフル前)
+
+    カードは「単語番号 * 2 + (日本語なら1)」の整数で表す。単語番号が同じカード同士がペアになる。
+    """
+    words_en = tuple(item["en"] for item in word_list)
+    words_jp = tuple(item["jp"] for item in word_list)
+    return words_en, words_jp, list(range(len(words_en) * 2))
+
+def init_game(word_list, time_limit, mode="NORMAL", poke_id=None, poke_img=None, story=None):
+    words_en, words_jp, slots = build_card_template(word_list)
+    random.shuffle(slots)
     
-    st.session_state.is_cleared = False
-    st.session_state.is_new_discovery = False
+    # 1ゲーム分の状態はまとめて入れ替える (前のゲームのリストはここで手放す)
+    st.session_state.update({
+        "words_en": words_en,
+        "words_jp": words_jp,
+        "slots": tuple(slots),  # 盤面の位置 i → カード番号
+        "flipped_mask": 0,  # めくっている位置 i を (1 << i) のビットで持つ
+        "first_flip": None,  # 1枚目にめくった位置 (ビットマスクではめくった順が分からないため)
+        "collected": {},  # 揃えた単語 (単語番号 → 英単語)。揃った順に並ぶ
+        "mistakes_now": [],
+        "mistakes_now_ids": set(),  # mistakes_now に入っている英単語 (重複チェック用)
+        "mastered_pending": [],
+        "current_mode": mode,
+
+        "current_poke_id": poke_id,
+        "current_poke_img": poke_img,
+
+        "deadline": time.time() + time_limit,
+        "time_limit": time_limit,
+        "game_state": "PLAYING",
+        "last_matched_word": None,
+        "revealing": False,  # ミスした2枚を表のまま見せているか (次のクリックで裏返す)
+
+        "is_cleared": False,
+        "is_new_discovery": False,
+        "finished_rendered": False,  # 結果画面を一度描いたか (演出を1回だけにする)
+        "story_drafts": [],
+        "story_idx": 0,
+        "pregen_story": story,  # 全単語を使った物語 (出題と同時に生成済みのもの)
+    })
+
+def finish_game(cleared):
+    """PLAYING → FINISHED の切り替え。DBへの書き込みはここでまとめて行う"""
+    st.session_state.is_cleared = cleared
+    # 全部揃えたなら、出題時に作っておいた物語をそのまま出す
+    if cleared and st.session_state.pregen_story:
+        st.session_state.story_drafts = [st.session_state.pregen_story]
+    if cleared and st.session_state.current_poke_id:
+        is_new = save_pokedex(st.session_state.current_poke_id)
+        st.session_state.is_new_discovery = is_new
+        if is_new and "my_pokedex" in st.session_state:
+            st.session_state.my_pokedex.append(st.session_state.current_poke_id)
+    if st.session_state.current_mode == "NORMAL" and st.session_state.mistakes_now:
+        # 結果画面を待たせないよう裏で書き込む (苦手単語の数は書き込み完了後に読み直す)
+        st.session_state.mistakes_future = get_executor().submit(
+            save_mistakes, list(st.session_state.mistakes_now)
+        )
+    if st.session_state.current_mode == "REVENGE" and st.session_state.collected:
+        # 揃えた単語の正解数はゲーム中には書かず、ここで1回にまとめて足す
+        counts = increment_correct_counts(st.session_state.collected.values())
+        st.session_state.mastered_pending = [w for w, c in counts.items() if c >= 10]
+    # 苦手単語が変わるので、取っておいた復習の出題は捨てる
+    st.session_state.pop("revenge_future", None)
+    st.session_state.game_state = "FINISHED"
+
+def flip_card(i):
+    """カードをめくる (on_click から呼ばれるので、クリック後の再実行1回で表示に反映される)"""
+    # ミスした2枚が表のままなら、次のクリックで裏返してから新しいカードをめくる
+    if st.session_state.revealing:
+        st.session_state.flipped_mask = 0
+        st.session_state.revealing = False
+    mask = st.session_state.flipped_mask
+    if not mask & (1 << i) and mask.bit_count() < 2:
+        if not mask:
+            st.session_state.first_flip = i
+        mask |= 1 << i
+        st.session_state.flipped_mask = mask
+        if mask.bit_count() == 2:
+            judge_pair(mask)
+
+def judge_pair(mask):
+    """2枚目をめくったクリックの中で当たり外れを判定する (描画の前に状態が決まる)"""
+    slots = st.session_state.slots
+    words_en = st.session_state.words_en
+    idx1, idx2 = flipped_pair(mask, st.session_state.first_flip)
+    w1, w2 = slots[idx1] // 2, slots[idx2] // 2
+
+    if w1 == w2:
+        # 揃ったカードは押せなくなるので、同じ単語が2回ここに来ることはない
+        collected = st.session_state.collected
+        collected[w1] = words_en[w1]
+        # トーストは再実行をまたいで残るので、最後のペアで結果画面に切り替わっても表示される
+        st.toast(f"Gotcha! {words_en[w1]}")
+        st.session_state.last_matched_word = words_en[w1]
+        st.session_state.flipped_mask = 0
+        if len(collected) == len(words_en):
+            finish_game(cleared=True)
+    else:
+        if st.session_state.current_mode == "NORMAL":
+            # 元の動作どおり、最初にめくったカードの単語を苦手として記録する
+            en = words_en[w1]
+            if en not in st.session_state.mistakes_now_ids:
+                st.session_state.mistakes_now_ids.add(en)
+                st.session_state.mistakes_now.append({"en": en, "jp": st.session_state.words_jp[w1]})
+        # ミスしたカードは sleep で待たずに表向きのまま残す (次のクリックの中で裏返る)
+        st.session_state.revealing = True
+
+def flipped_pair(mask, first):
+    """2枚めくられたビットマスクから、その位置を (1枚目, 2枚目) のめくった順で取り出す"""
+    return first, (mask ^ (1 << first)).bit_length() - 1
+
+@st.fragment(run_every=1)
+def game_timer():
+    """残り時間の表示 (1秒ごとにこの部分だけ再実行され、盤面は描き直さない)"""
+    # クリックでゲームが終わった直後の tick なら、時間切れ扱いにせず画面全体を描き直す
+    if st.session_state.game_state != "PLAYING":
+        st.rerun()
+    now = time.time()
+    remaining = st.session_state.deadline - now
+    st.progress(max(0.0, remaining / st.session_state.time_limit))
+    st.caption(f"残り時間: {max(0.0, remaining):.1f}秒")
+
+    if remaining <= 0:
+        finish_game(cleared=False)
+        st.rerun()
+
+@st.fragment
+def game_board():
+    """プレイ中の盤面 (カードのクリックではこの部分だけ再実行される)"""
+    # 最後のペアを揃えたクリックで結果画面に切り替わっていたら、画面全体を描き直す
+    if st.session_state.game_state != "PLAYING":
+        st.rerun()
+
+    if st.session_state.last_matched_word:
+        st.success(f"Nice! 🔊 {st.session_state.last_matched_word}")
+        play_pronunciation(st.session_state.last_matched_word)
+        st.session_state.last_matched_word = None
+
+    # ミスのメッセージ用の枠 (次のクリックで状態が戻れば何も書かれず消える)
+    feedback = st.empty()
+
+    # ループ内で session_state の属性参照を繰り返さないようにローカルに取り出しておく
+    collected = st.session_state.collected
+    mask = st.session_state.flipped_mask
+    words_en = st.session_state.words_en
+    words_jp = st.session_state.words_jp
+    slots = st.session_state.slots
+    # 列ごとにまとめて描画する (位置 i は i % 4 列目に入るので並びは変わらない)
+    board = list(enumerate(slots))
+    for c, col in enumerate(st.columns(4)):
+        with col:
+            for i, card in board[c::4]:
+                w, is_jp = divmod(card, 2)
+                text = words_jp[w] if is_jp else words_en[w]
+                is_matched = w in collected
+                is_flipped = bool(mask & (1 << i))
+                label = f"✨ {text}" if is_matched else (text if is_flipped else "◓")
+                st.button(label, key=f"btn_{i}", disabled=is_matched, on_click=flip_card, args=(i,))
+
+    # ミスした2枚は表のまま、理由を出しておく
+    if st.session_state.revealing:
+        texts = []
+        for i in flipped_pair(mask, st.session_state.first_flip):
+            w, is_jp = divmod(slots[i], 2)
+            texts.append(words_jp[w] if is_jp else words_en[w])
+        feedback.error(f"ああっ！逃げられた！ ({texts[0]} ≠ {texts[1]})")
 
 # ==========================================
 # 4. アプリ本体
@@ -257,30 +651,50 @@ def init_game(word_list, time_limit, mode="NORMAL", poke_id=None, poke_img=None)
 def main():
     # サイドバー
     st.sidebar.title("⚙️ メニュー")
-    api_key = st.sidebar.text_input("Gemini API Key", type="password")
-    
-    rank_keys = list(RANK_MAP.keys())
-    rank_options = rank_keys + ["🔥 復習モード (Revenge)"]
-    selected_rank_name = st.sidebar.selectbox("挑戦するランク", rank_options)
+
+    # 入力途中で毎回再実行されないよう、設定はフォームでまとめて反映する
+    with st.sidebar.form("settings"):
+        api_key = st.text_input("Gemini API Key", type="password")
+        selected_rank_name = st.selectbox("挑戦するランク", RANK_OPTIONS)
+        st.form_submit_button("設定を反映")
     
     st.sidebar.divider()
-    m_count = get_mistakes_count()
+    # 裏での苦手単語の書き込みが終わっていたら、数を読み直す
+    future = st.session_state.get("mistakes_future")
+    if future is not None and future.done():
+        del st.session_state.mistakes_future
+        st.session_state.count_dirty = True
+    # 苦手単語の数は、書き込みがあったとき (count_dirty) だけDBから読み直す
+    if st.session_state.get("count_dirty", True) or "cached_count" not in st.session_state:
+        st.session_state.cached_count = get_mistakes_count()
+        st.session_state.count_dirty = False
+    m_count = st.session_state.cached_count
     st.sidebar.error(f"💀 苦手な単語: {m_count} 語")
     
     # 図鑑
     st.sidebar.divider()
     with st.sidebar.expander("📖 ポケモン図鑑 (Pokedex)"):
-        my_pokedex = get_my_pokedex()
+        # 図鑑は初回だけDBから読み、以降は session_state の写しを差分更新する
+        if "my_pokedex" not in st.session_state:
+            st.session_state.my_pokedex = list(get_my_pokedex())
+        my_pokedex = st.session_state.my_pokedex
         if my_pokedex:
             st.write(f"現在の発見数: **{len(my_pokedex)}** 匹")
-            cols = st.columns(3)
-            for i, pid in enumerate(my_pokedex):
-                img_url = f"https://raw.githubusercontent.com/PokeAPI/sprites/master/sprites/pokemon/{pid}.png"
-                with cols[i % 3]:
-                    st.image(img_url, width=70)
+            # 1つのHTMLにまとめ、画像の読み込みは開いて見えたときまでブラウザに遅らせる
+            imgs = "".join(
+                f'<img loading="lazy" src="{SPRITE_URL.format(pid)}" width="70" height="70">'
+                for pid in my_pokedex
+            )
+            st.markdown(f'<div style="display:flex;flex-wrap:wrap;gap:4px">{imgs}</div>', unsafe_allow_html=True)
         else:
             st.info("まだポケモンを捕まえていません。")
 
+    # 開発用: session_state のキーごとの大きさ。getsizeof は入れ物自体のサイズだけで、中身は数えない
+    if DEBUG and st.sidebar.toggle("Debug"):
+        sizes = {k: sys.getsizeof(v) for k, v in st.session_state.items()}
+        st.sidebar.caption("session_state の浅いサイズ (バイト、中身は含まない)")
+        st.sidebar.json(dict(sorted(sizes.items(), key=lambda kv: -kv[1])))
+
     # メイン画面
     st.title("◓ ポケモン英単語ゲーム")
     
@@ -294,101 +708,60 @@ def main():
                 st.info("復習する単語はありません！")
             else:
                 st.write(f"過去に逃げられた **{m_count}** 匹の単語が待っている...")
+                # 画面を見ている間に出題を取っておき、ボタンを押したらそれを使う
+                # (前のゲームの苦手単語を書き込み中なら、書き終わるまで取りに行かない)
+                saving = "mistakes_future" in st.session_state
+                if not saving and "revenge_future" not in st.session_state:
+                    st.session_state.revenge_future = get_executor().submit(fetch_revenge_words, QUIZ_WORDS)
                 if st.button("リベンジバトル開始！", type="primary"):
-                    revenge_words = fetch_revenge_words(8)
+                    revenge_words = None
+                    future = st.session_state.pop("revenge_future", None)
+                    if future is not None:
+                        try: revenge_words = future.result()
+                        except: pass
+                    if not revenge_words:
+                        # 先読みがない・失敗したときは、書き込みを待ってからその場で取る
+                        if saving:
+                            st.session_state.mistakes_future.result()
+                        revenge_words = fetch_revenge_words(QUIZ_WORDS)
                     if not revenge_words:
                         st.error("データ取得失敗")
                     else:
-                        init_game(revenge_words, 40, mode="REVENGE", poke_id=132, poke_img="https://raw.githubusercontent.com/PokeAPI/sprites/master/sprites/pokemon/132.png")
+                        init_game(revenge_words, 40, mode="REVENGE", poke_id=132, poke_img=SPRITE_URL.format(132))
                         st.rerun()
         else:
-            st.write(f"**{selected_rank_name}** の野生の単語が現れた！(8匹)")
+            st.write(f"**{selected_rank_name}** の野生の単語が現れた！({QUIZ_WORDS}匹)")
             st.caption("※ すべてのカードを揃えると図鑑に登録されます")
             if not api_key:
                 st.caption("⚠️ AIキー未設定: オフライン単語帳から出題されます")
             
             if st.button("バトル開始！ (Start)", type="primary"):
                 with st.spinner("草むらから単語を探しています..."):
-                    rank_idx = rank_keys.index(selected_rank_name)
+                    rank_idx = RANK_INDEX[selected_rank_name]
                     pid, pimg = get_random_pokemon_data(rank_idx)
-                    quiz_data = generate_quiz_words(api_key, RANK_MAP[selected_rank_name], selected_rank_name)
-                    init_game(quiz_data, 30, mode="NORMAL", poke_id=pid, poke_img=pimg) 
+                    quiz_data, story = take_quiz_words(api_key, selected_rank_name)
+                    init_game(quiz_data, 30, mode="NORMAL", poke_id=pid, poke_img=pimg, story=story)
                     st.rerun()
 
     # B. プレイ中
     elif st.session_state.game_state == "PLAYING":
+        # 遊んでいる間に、同じランクの次のゲームの単語を用意しておく
+        if st.session_state.current_mode == "NORMAL" and selected_rank_name in RANK_MAP:
+            prefetch_quiz(api_key, selected_rank_name)
+
         col_info, col_img = st.columns([3, 1])
         with col_info:
             if st.session_state.current_mode == "REVENGE":
                 st.warning("🔥 REVENGE BATTLE")
             else:
                 st.info("野生の 英単語モンスター が勝負を仕掛けてきた！")
-                
-            elapsed = time.time() - st.session_state.start_time
-            remaining = st.session_state.time_limit - elapsed
-            st.progress(max(0.0, remaining / st.session_state.time_limit))
-            st.caption(f"残り時間: {remaining:.1f}秒")
-        
+            game_timer()
+
         with col_img:
             if st.session_state.current_poke_img:
                 st.image(st.session_state.current_poke_img, width=120)
 
-        if st.session_state.last_matched_word:
-            st.success(f"Nice! 🔊 {st.session_state.last_matched_word}")
-            play_pronunciation(st.session_state.last_matched_word)
-            st.session_state.last_matched_word = None
-
-        if remaining <= 0:
-            st.session_state.game_state = "FINISHED"
-            st.session_state.is_cleared = False
-            st.rerun()
-
-        cols = st.columns(4)
-        for i, card in enumerate(st.session_state.cards):
-            is_matched = card["id"] in st.session_state.matched
-            is_flipped = i in st.session_state.flipped
-            label = f"✨ {card['text']}" if is_matched else (card["text"] if is_flipped else "◓")
-
-            with cols[i % 4]:
-                if st.button(label, key=f"btn_{i}", disabled=is_matched):
-                    if not is_flipped and len(st.session_state.flipped) < 2:
-                        st.session_state.flipped.append(i)
-                        st.rerun()
-
-        if len(st.session_state.flipped) == 2:
-            idx1, idx2 = st.session_state.flipped
-            c1, c2 = st.session_state.cards[idx1], st.session_state.cards[idx2]
-
-            if c1["id"] == c2["id"]:
-                st.toast(f"Gotcha! {c1['id']}")
-                st.session_state.matched.add(c1["id"])
-                st.session_state.last_matched_word = c1["id"]
-                
-                if c1["id"] not in st.session_state.collected_now:
-                    st.session_state.collected_now.append(c1["id"])
-                    if st.session_state.current_mode == "REVENGE":
-                        if increment_correct_count(c1["id"]) >= 10:
-                            st.session_state.mastered_pending.append(c1["id"])
-                
-                st.session_state.flipped = []
-                if len(st.session_state.matched) * 2 == len(st.session_state.cards):
-                    st.session_state.is_cleared = True
-                    if st.session_state.current_poke_id:
-                        is_new = save_pokedex(st.session_state.current_poke_id)
-                        st.session_state.is_new_discovery = is_new
-                    st.session_state.game_state = "FINISHED"
-                    st.rerun()
-                time.sleep(0.5)
-                st.rerun()
-            else:
-                st.error(f"ああっ！逃げられた！ ({c1['text']} ≠ {c2['text']})")
-                if st.session_state.current_mode == "NORMAL":
-                    save_mistake(c1["id"], c1["pair"] if not c1["is_jp"] else c1["text"])
-                    if not any(m["en"] == c1["id"] for m in st.session_state.mistakes_now):
-                        st.session_state.mistakes_now.append({"en": c1["id"], "jp": c1["pair"] if not c1["is_jp"] else c1["text"]})
-                time.sleep(1.0)
-                st.session_state.flipped = []
-                st.rerun()
+        game_board()
 
     # C. 結果画面
     elif st.session_state.game_state == "FINISHED":
@@ -399,7 +772,9 @@ def main():
             if st.session_state.current_poke_img:
                 st.image(st.session_state.current_poke_img, width=120)
                 if st.session_state.is_new_discovery:
-                    st.balloons()
+                    # 物語の切り替えなどで再実行されても、風船は最初の1回だけ飛ばす
+                    if not st.session_state.finished_rendered:
+                        st.balloons()
                     st.success("🌟 やった！ 新しいポケモンを図鑑に登録しました！")
                 else:
                     st.info("このポケモンはすでに登録済みです。")
@@ -407,32 +782,46 @@ def main():
             st.error("Time Up! 野生のポケモンは逃げ出してしまった...")
             if st.session_state.current_poke_img:
                 st.image(st.session_state.current_poke_img, width=100, caption="逃げたポケモン")
+        st.session_state.finished_rendered = True
 
         st.divider()
 
-        if st.session_state.collected_now:
+        if st.session_state.collected:
             msg = "復習できた単語" if st.session_state.current_mode == "REVENGE" else "ゲットした単語"
-            st.write(f"**{msg}:** {', '.join(st.session_state.collected_now)}")
+            st.write(f"**{msg}:** {', '.join(st.session_state.collected.values())}")
             
             st.subheader("📖 冒険の記録")
             if st.button("記録を書く (Generate English Story)"):
-                with st.spinner("Writing story..."):
-                    story = get_english_story(api_key, st.session_state.collected_now)
-                    st.info(story)
+                # 生成中の文章はストリーミングで表示し、完了後は下の表示に切り替える
+                st.session_state.story_drafts = write_english_story(api_key, list(st.session_state.collected.values()))
+                st.session_state.story_idx = 0
+                st.rerun()
+
+            drafts = st.session_state.story_drafts
+            if drafts:
+                st.info(drafts[st.session_state.story_idx])
+                if len(drafts) > 1 and st.button("別の物語を作る"):
+                    st.session_state.story_idx = (st.session_state.story_idx + 1) % len(drafts)
+                    st.rerun()
         else:
             st.warning("単語を一匹も捕まえられなかった...")
 
+        # 卒業ボタンの後の再実行で、風船を1回だけ飛ばす (ボタンの中で出すと再実行で途切れる)
+        if st.session_state.pop("graduated", False):
+            st.balloons()
+
         pending = st.session_state.mastered_pending
         if pending:
             st.success(f"🎉 卒業候補: {', '.join(pending)}")
             col1, col2 = st.columns(2)
             with col1:
                 if st.button("✅ リストから削除して卒業"):
-                    for w in pending: delete_mistake(w)
-                    st.balloons()
-                    st.success("卒業しました！")
+                    delete_mistakes(pending)
+                    st.session_state.count_dirty = True
+                    st.session_state.graduated = True
+                    # トーストは再実行しても消えないので、待たずに画面を描き直せる
+                    st.toast("卒業しました！", icon="🎉")
                     st.session_state.mastered_pending = []
-                    time.sleep(2)
                     st.rerun()
             with col2:
                 if st.button("残しておく"):